@@ -31,17 +31,21 @@ __attribute__((used)) static const int kFixnumMask = 0x3;
 __attribute__((used)) static const int kFixnumShift = 2;
 __attribute__((used)) static const int kHeapObjectMask = 0x7;
 
-int32_t encodeImmediateFixnum(int32_t f) {
+// The encoders are pure and almost always called with constant arguments
+// (encodeImmediateFixnum(1), encodeImmediateBool(false), ...), so let the C
+// compiler fold them at the call site rather than re-running them per node.
+static inline int32_t encodeImmediateFixnum(int32_t f) {
   assert(f < 0x7fffffff && "too big");
   assert(f > -0x80000000L && "too small");
   return f << kFixnumShift;
 }
 
-int32_t encodeImmediateBool(bool value) {
-  return ((value ? 1L : 0L) << kBoolShift) | kBoolTag;
+static inline int32_t encodeImmediateBool(bool value) {
+  // A C99 bool is already 0 or 1, so no branch is needed to pick the bit.
+  return ((int32_t)value << kBoolShift) | kBoolTag;
 }
 
-int32_t encodeImmediateChar(char c) {
+static inline int32_t encodeImmediateChar(char c) {
   return ((int32_t)c << kCharShift) | kCharTag;
 }
 
@@ -95,25 +99,27 @@ void BufferWriter_init(BufferWriter *writer, Buffer *buf) {
   writer->pos = 0;
 }
 
-const int kBitsPerByte = 8; // bits
-const int kWordSize = 8;    // bytes
+const int kWordSize = 8; // bytes
 
 void BufferWriter_backpatch_displacement_imm32(BufferWriter *writer,
                                                int32_t pos_after_jump) {
   int32_t relative = writer->pos - pos_after_jump;
   int32_t displacement_first_byte = pos_after_jump - sizeof(int32_t);
-  for (size_t i = 0; i < sizeof(int32_t); i++) {
-    Buffer_at_put(writer->buf, displacement_first_byte + i,
-                  (relative >> (i * kBitsPerByte)) & 0xff);
-  }
+  // See Buffer_write32.
+  memcpy(writer->buf->address + displacement_first_byte, &relative,
+         sizeof relative);
 }
 size_t BufferWriter_get_pos(BufferWriter *writer) { return writer->pos; }
 
 void Buffer_dump(BufferWriter *writer, FILE *fp) {
+  static const char kHexDigits[] = "0123456789abcdef";
   for (size_t i = 0; i < writer->pos; i++) {
-    fprintf(fp, "%.2x ", writer->buf->address[i]);
+    byte b = writer->buf->address[i];
+    fputc(kHexDigits[b >> 4], fp);
+    fputc(kHexDigits[b & 0xf], fp);
+    fputc(' ', fp);
   }
-  fprintf(fp, "\n");
+  fputc('\n', fp);
 }
 
 void Buffer_write8(BufferWriter *writer, byte b) {
@@ -121,16 +127,17 @@ void Buffer_write8(BufferWriter *writer, byte b) {
   Buffer_at_put(writer->buf, writer->pos++, b);
 }
 
-void Buffer_write_arr(BufferWriter *writer, byte *arr, size_t len) {
-  for (size_t i = 0; i < len; i++) {
-    Buffer_write8(writer, arr[i]);
-  }
+// Copy a whole run of bytes with one bounds check instead of one per byte.
+void Buffer_write_arr(BufferWriter *writer, const byte *arr, size_t len) {
+  assert(writer->pos + len <= writer->buf->len);
+  memcpy(writer->buf->address + writer->pos, arr, len);
+  writer->pos += len;
 }
 
 void Buffer_write32(BufferWriter *writer, int32_t value) {
-  for (size_t i = 0; i < 4; i++) {
-    Buffer_write8(writer, (value >> (i * kBitsPerByte)) & 0xff);
-  }
+  // We only ever generate (and run) x86-64 code, which is little-endian, so
+  // the in-memory representation of `value` already is its imm32 encoding.
+  Buffer_write_arr(writer, (const byte *)&value, sizeof value);
 }
 
 typedef enum {
@@ -153,15 +160,13 @@ typedef enum {
 } Condition;
 
 void Buffer_inc_reg(BufferWriter *writer, Register reg) {
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0xff);
-  Buffer_write8(writer, 0xc0 + reg);
+  byte insn[] = {0x48, 0xff, 0xc0 + reg};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_dec_reg(BufferWriter *writer, Register reg) {
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0xff);
-  Buffer_write8(writer, 0xc8 + reg);
+  byte insn[] = {0x48, 0xff, 0xc8 + reg};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_mov_reg_imm32(BufferWriter *writer, Register dst, int32_t src) {
@@ -181,13 +186,27 @@ void Buffer_add_reg_imm32(BufferWriter *writer, Register dst, int32_t src) {
   Buffer_write32(writer, src);
 }
 
+// Unlike Buffer_add_reg_imm32, this is a 64-bit add: the imm32 is
+// sign-extended and the upper half of dst is preserved.
+void Buffer_add_reg64_imm32(BufferWriter *writer, Register dst, int32_t src) {
+  Buffer_write8(writer, 0x48);
+  if (dst == kRax) {
+    // Optimization: add rax, {imm32} can either be encoded as 48 05 {imm32} or
+    // 48 81 c0 {imm32}.
+    Buffer_write8(writer, 0x05);
+    Buffer_write32(writer, src);
+    return;
+  }
+  Buffer_write8(writer, 0x81);
+  Buffer_write8(writer, 0xc0 + dst);
+  Buffer_write32(writer, src);
+}
+
 void Buffer_add_reg_stack(BufferWriter *writer, Register dst, int8_t offset) {
   assert(offset < 0 && "positive stack offset unimplemented");
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x03);
-  Buffer_write8(writer, 0x04 + (dst * 8) + (offset == 0 ? 0 : 0x40));
-  Buffer_write8(writer, 0x24);
-  Buffer_write8(writer, 0x100 + offset);
+  byte insn[] = {0x48, 0x03, 0x04 + (dst * 8) + (offset == 0 ? 0 : 0x40), 0x24,
+                 0x100 + offset};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 static uint8_t encode_disp(int8_t disp) {
@@ -198,18 +217,14 @@ static uint8_t encode_disp(int8_t disp) {
 
 void Buffer_mov_rax_to_reg_disp(BufferWriter *writer, Register dst,
                                 int8_t disp) {
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x89);
-  Buffer_write8(writer, 0x40 + dst);
-  Buffer_write8(writer, encode_disp(disp));
+  byte insn[] = {0x48, 0x89, 0x40 + dst, encode_disp(disp)};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_mov_reg_disp_to_rax(BufferWriter *writer, Register dst,
                                 int8_t disp) {
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x8b);
-  Buffer_write8(writer, 0x40 + dst);
-  Buffer_write8(writer, encode_disp(disp));
+  byte insn[] = {0x48, 0x8b, 0x40 + dst, encode_disp(disp)};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_sub_reg_imm32(BufferWriter *writer, Register dst, int32_t src) {
@@ -225,38 +240,31 @@ void Buffer_sub_reg_imm32(BufferWriter *writer, Register dst, int32_t src) {
 }
 
 void Buffer_mov_reg_reg(BufferWriter *writer, Register dst, Register src) {
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x89);
-  Buffer_write8(writer, 0xc0 + dst + src * 8);
+  byte insn[] = {0x48, 0x89, 0xc0 + dst + src * 8};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_mov_reg_to_stack(BufferWriter *writer, Register src,
                              int8_t offset) {
   assert(offset < 0 && "positive stack offset unimplemented");
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x89);
-  Buffer_write8(writer, 0x04 + (src * 8) + (offset == 0 ? 0 : 0x40));
-  Buffer_write8(writer, 0x24);
-  Buffer_write8(writer, 0x100 + offset);
+  byte insn[] = {0x48, 0x89, 0x04 + (src * 8) + (offset == 0 ? 0 : 0x40), 0x24,
+                 0x100 + offset};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_mov_stack_to_reg(BufferWriter *writer, Register dst,
                              int8_t offset) {
   assert(offset < 0 && "positive stack offset unimplemented");
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x8b);
-  Buffer_write8(writer, 0x04 + (dst * 8) + (offset == 0 ? 0 : 0x40));
-  Buffer_write8(writer, 0x24);
-  Buffer_write8(writer, 0x100 + offset);
+  byte insn[] = {0x48, 0x8b, 0x04 + (dst * 8) + (offset == 0 ? 0 : 0x40), 0x24,
+                 0x100 + offset};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_shl_reg(BufferWriter *writer, Register dst, int8_t bits) {
   assert(bits >= 0 && "too few bits");
   assert(bits < 64 && "too many bits");
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0xc1);
-  Buffer_write8(writer, 0xe0 + dst);
-  Buffer_write8(writer, bits);
+  byte insn[] = {0x48, 0xc1, 0xe0 + dst, bits};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 void Buffer_and_reg_imm32(BufferWriter *writer, Register dst, int32_t value) {
@@ -296,17 +304,15 @@ void Buffer_cmp_reg_imm32(BufferWriter *writer, Register dst, int32_t value) {
     Buffer_write32(writer, value);
     return;
   }
-  Buffer_write8(writer, 0x48);
-  Buffer_write8(writer, 0x81);
-  Buffer_write8(writer, 0xf8 + dst);
+  byte insn[] = {0x48, 0x81, 0xf8 + dst};
+  Buffer_write_arr(writer, insn, sizeof insn);
   Buffer_write32(writer, value);
 }
 
 void Buffer_setcc_reg(BufferWriter *writer, Condition cond, SubRegister dst) {
   assert(cond == kEqual && "other conditions unimplemented");
-  Buffer_write8(writer, 0x0f);
-  Buffer_write8(writer, 0x94);
-  Buffer_write8(writer, 0xc0 + dst);
+  byte insn[] = {0x0f, 0x94, 0xc0 + dst};
+  Buffer_write_arr(writer, insn, sizeof insn);
 }
 
 // Relative jump
@@ -339,6 +345,27 @@ void Buffer_call_imm32(BufferWriter *writer, int32_t disp) {
 
 void Buffer_ret(BufferWriter *writer) { Buffer_write8(writer, 0xc3); }
 
+// Turn the result of a preceding cmp into a tagged boolean in rax. Every
+// predicate ends with the same four instructions, so they are written from one
+// template, followed by the imm32 of the `or`:
+//
+// b8 00 00 00 00          mov    eax,0x0
+// 0f 94 c0                sete   al
+// 48 c1 e0 07             shl    rax,0x7
+// 48 0d 1f 00 00 00       or     rax,0x1f
+void Buffer_box_equal_flag_as_bool(BufferWriter *writer) {
+  assert(kBoolShift >= 0 && "too few bits");
+  assert(kBoolShift < 64 && "too many bits");
+  byte insn[] = {
+      0xb8 + kRax, 0x00, 0x00,        0x00,       0x00, // mov eax, 0
+      0x0f,        0x94, 0xc0 + kAl,                    // sete al
+      0x48,        0xc1, 0xe0 + kRax, kBoolShift,       // shl rax, kBoolShift
+      0x48,        0x0d,                                // or rax, imm32
+  };
+  Buffer_write_arr(writer, insn, sizeof insn);
+  Buffer_write32(writer, kBoolTag);
+}
+
 // End Machine code
 
 // Env
@@ -382,13 +409,13 @@ EnvNode Env_init(char *name, int32_t stack_index, EnvNode *next) {
 bool Env_lookup(EnvNode *env, char *name, int32_t *stack_index) {
   assert(name != NULL);
   assert(stack_index != NULL);
-  if (env == NULL)
-    return false;
-  if (env->name == name || strcmp(env->name, name) == 0) {
-    *stack_index = env->stack_index;
-    return true;
+  for (; env != NULL; env = env->next) {
+    if (env->name == name || strcmp(env->name, name) == 0) {
+      *stack_index = env->stack_index;
+      return true;
+    }
   }
-  return Env_lookup(env->next, name, stack_index);
+  return false;
 }
 
 // End Env
@@ -428,10 +455,14 @@ ASTNode *AST_new_fixnum(int fixnum) {
   return result;
 }
 
+// The name is stored inline, directly after the node, so an atom is a single
+// allocation and its name sits next to it in memory.
 ASTNode *AST_new_atom(char *atom) {
-  ASTNode *result = malloc(sizeof *result);
+  size_t size = strlen(atom) + 1; // +1 for NUL
+  ASTNode *result = malloc(sizeof *result + size);
   result->type = kAtom;
-  result->value.atom = strdup(atom);
+  result->value.atom = (char *)(result + 1);
+  memcpy(result->value.atom, atom, size);
   return result;
 }
 
@@ -451,7 +482,9 @@ int AST_is_atom(ASTNode *node) { return node->type == kAtom; }
 
 int AST_atom_equals_cstr(ASTNode *node, char *cstr) {
   assert(AST_is_atom(node));
-  return strcmp(node->value.atom, cstr) == 0;
+  // Most mismatches (eg when scanning the table of calls) differ in the first
+  // character, so check that before paying for a full strcmp.
+  return node->value.atom[0] == cstr[0] && strcmp(node->value.atom, cstr) == 0;
 }
 
 ASTNode *AST_car(ASTNode *cons) {
@@ -571,31 +604,46 @@ CompilerContext CompilerContext_with_locals(CompilerContext *ctx,
 // End Compiler context
 
 // env is a map of variables to stack locations
-int AST_compile_expr(CompilerContext *ctx, ASTNode *node, int stack_index);
+static int AST_compile_expr(CompilerContext *ctx, ASTNode *node,
+                            int stack_index);
 
-ASTNode *operand1(ASTNode *args) { return AST_car(args); }
-ASTNode *operand2(ASTNode *args) { return AST_car(AST_cdr(args)); }
-ASTNode *operand3(ASTNode *args) { return AST_car(AST_cdr(AST_cdr(args))); }
+static ASTNode *operand1(ASTNode *args) { return AST_car(args); }
+static ASTNode *operand2(ASTNode *args) { return AST_car(AST_cdr(args)); }
+static ASTNode *operand3(ASTNode *args) {
+  return AST_car(AST_cdr(AST_cdr(args)));
+}
 
-int AST_compile_let(CompilerContext *ctx, ASTNode *bindings, ASTNode *body,
-                    int stack_index) {
-  if (bindings == nil) {
-    // Base case: no bindings. Emit the body.
-    AST_compile_expr(ctx, body, stack_index);
-    return 0;
+static int AST_compile_let(CompilerContext *ctx, ASTNode *bindings,
+                           ASTNode *body, int stack_index) {
+  int num_bindings = 0;
+  for (ASTNode *it = bindings; it != nil; it = AST_cdr(it)) {
+    num_bindings++;
   }
-  // Inductive case: some bindings. Emit code for the first binding, bind the
-  // name to the stack index, and recurse.
-  ASTNode *first_binding = AST_car(bindings);
-  ASTNode *name = AST_car(first_binding);
-  assert(name && name->type == kAtom && "name must be an atom");
-  ASTNode *expr = AST_car(AST_cdr(first_binding));
-  AST_compile_expr(ctx, expr, stack_index);
-  Buffer_mov_reg_to_stack(ctx->writer, kRax, stack_index);
-  EnvNode new_locals = Env_init(name->value.atom, stack_index, ctx->locals);
-  CompilerContext new_ctx = CompilerContext_with_locals(ctx, &new_locals);
-  return AST_compile_let(&new_ctx, AST_cdr(bindings), body,
-                         stack_index - kWordSize);
+  if (num_bindings == 0) {
+    // No bindings. Emit the body.
+    return AST_compile_expr(ctx, body, stack_index);
+  }
+  // Emit code for each binding in turn, binding the name to its stack index
+  // as we go so later bindings can see earlier ones. The EnvNodes live in
+  // this frame, one per binding, so nothing is heap-allocated.
+  EnvNode new_locals[num_bindings];
+  CompilerContext new_ctx = CompilerContext_with_locals(ctx, ctx->locals);
+  int i = 0;
+  for (ASTNode *it = bindings; it != nil; it = AST_cdr(it), i++) {
+    ASTNode *binding = AST_car(it);
+    ASTNode *name = AST_car(binding);
+    assert(name && name->type == kAtom && "name must be an atom");
+    ASTNode *expr = AST_car(AST_cdr(binding));
+    int result = AST_compile_expr(&new_ctx, expr, stack_index);
+    if (result != 0) {
+      return result;
+    }
+    Buffer_mov_reg_to_stack(ctx->writer, kRax, stack_index);
+    new_locals[i] = Env_init(name->value.atom, stack_index, new_ctx.locals);
+    new_ctx = CompilerContext_with_locals(&new_ctx, &new_locals[i]);
+    stack_index -= kWordSize;
+  }
+  return AST_compile_expr(&new_ctx, body, stack_index);
 }
 
 // http://ref.x86asm.net/coder32.html
@@ -603,8 +651,8 @@ int AST_compile_let(CompilerContext *ctx, ASTNode *bindings, ASTNode *body,
 // rasm2 -D -b64 "48 89 44 24 f8 "
 //  -> or -d
 
-int AST_compile_if(CompilerContext *ctx, ASTNode *test, ASTNode *iftrue,
-                   ASTNode *iffalse, int stack_index) {
+static int AST_compile_if(CompilerContext *ctx, ASTNode *test, ASTNode *iftrue,
+                          ASTNode *iffalse, int stack_index) {
   AST_compile_expr(ctx, test, stack_index);
   Buffer_cmp_reg_imm32(ctx->writer, kRax, encodeImmediateBool(false));
   Buffer_je_imm32(ctx->writer, 0x12345678);
@@ -618,8 +666,8 @@ int AST_compile_if(CompilerContext *ctx, ASTNode *test, ASTNode *iftrue,
   return 0;
 }
 
-int AST_compile_cons(CompilerContext *ctx, ASTNode *car, ASTNode *cdr,
-                     int stack_index) {
+static int AST_compile_cons(CompilerContext *ctx, ASTNode *car, ASTNode *cdr,
+                            int stack_index) {
   AST_compile_expr(ctx, car, stack_index - kWordSize);
   // Set car
   Buffer_mov_rax_to_reg_disp(ctx->writer, kRsi, 0);
@@ -634,8 +682,8 @@ int AST_compile_cons(CompilerContext *ctx, ASTNode *car, ASTNode *cdr,
   return 0;
 }
 
-int AST_compile_code(CompilerContext *ctx, ASTNode *formals, ASTNode *body,
-                     int stack_index) {
+static int AST_compile_code(CompilerContext *ctx, ASTNode *formals,
+                            ASTNode *body, int stack_index) {
   if (formals == nil) {
     int result = AST_compile_expr(ctx, body, stack_index);
     if (result != 0) {
@@ -651,8 +699,8 @@ int AST_compile_code(CompilerContext *ctx, ASTNode *formals, ASTNode *body,
                           stack_index - kWordSize);
 }
 
-int AST_compile_labelcall(CompilerContext *ctx, int32_t code_pos, ASTNode *args,
-                          int stack_index) {
+static int AST_compile_labelcall(CompilerContext *ctx, int32_t code_pos,
+                                 ASTNode *args, int stack_index) {
   assert(args->type == kCons);
   if (args == nil) {
     int32_t disp = code_pos - BufferWriter_get_pos(ctx->writer);
@@ -669,113 +717,209 @@ int AST_compile_labelcall(CompilerContext *ctx, int32_t code_pos, ASTNode *args,
                                stack_index - kWordSize);
 }
 
-int AST_compile_call(CompilerContext *ctx, ASTNode *fnexpr, ASTNode *args,
-                     int stack_index) {
-  if (AST_is_atom(fnexpr)) {
-    // Assumed to be a primcall
-    if (AST_atom_equals_cstr(fnexpr, "add1")) {
-      AST_compile_expr(ctx, operand1(args), stack_index);
-      Buffer_add_reg_imm32(ctx->writer, kRax, encodeImmediateFixnum(1));
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "sub1")) {
-      AST_compile_expr(ctx, operand1(args), stack_index);
-      Buffer_sub_reg_imm32(ctx->writer, kRax, encodeImmediateFixnum(1));
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "integer->char")) {
-      AST_compile_expr(ctx, operand1(args), stack_index);
-      Buffer_shl_reg(ctx->writer, kRax, /*bits=*/kCharShift - kFixnumShift);
-      // TODO: generate more compact code since we know we're only or-ing with a
-      // byte
-      Buffer_or_reg_imm32(ctx->writer, kRax, kCharTag);
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "zero?")) {
-      AST_compile_expr(ctx, operand1(args), stack_index);
-      Buffer_cmp_reg_imm32(ctx->writer, kRax, 0);
-      Buffer_mov_reg_imm32(ctx->writer, kRax, 0);
-      Buffer_setcc_reg(ctx->writer, kEqual, kAl);
-      Buffer_shl_reg(ctx->writer, kRax, kBoolShift);
-      Buffer_or_reg_imm32(ctx->writer, kRax, kBoolTag);
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "+")) {
-      AST_compile_expr(ctx, operand2(args), stack_index);
-      Buffer_mov_reg_to_stack(ctx->writer, kRax, /*offset=*/stack_index);
-      AST_compile_expr(ctx, operand1(args), stack_index - kWordSize);
-      Buffer_add_reg_stack(ctx->writer, kRax, /*offset=*/stack_index);
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "let")) {
-      return AST_compile_let(ctx, /*bindings=*/operand1(args),
-                             /*body=*/operand2(args), stack_index);
-    }
-    if (AST_atom_equals_cstr(fnexpr, "if")) {
-      // TODO: in if, rewrite empty iffalse => '()
-      return AST_compile_if(ctx, operand1(args), operand2(args), operand3(args),
-                            stack_index);
-    }
-    if (AST_atom_equals_cstr(fnexpr, "cons")) {
-      return AST_compile_cons(ctx, operand1(args), operand2(args), stack_index);
-    }
-    if (AST_atom_equals_cstr(fnexpr, "car")) {
-      AST_compile_expr(ctx, operand1(args), stack_index);
-      // Since heap addresses are biased by 1, the car of a cons cell is at
-      // offset -1, instead of 0.
-      Buffer_mov_reg_disp_to_rax(ctx->writer, /*src=*/kRax, -1);
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "cdr")) {
-      AST_compile_expr(ctx, operand1(args), stack_index);
-      // Since heap addresses are biased by 1, the cdr of a cons cell is at
-      // offset 7, instead of 8.
-      Buffer_mov_reg_disp_to_rax(ctx->writer, /*src=*/kRax, kWordSize - 1);
-      return 0;
-    }
-    if (AST_atom_equals_cstr(fnexpr, "code")) {
-      // The flow of control enters `code` in a new call frame. The stack looks
-      // like this:
-      //
-      // low addr
-      // --------
-      // .
-      // .
-      // .
-      // rsp   24: arg3
-      // rsp - 16: arg2
-      // rsp - 8 : arg1
-      // rsp     : return addr
-      // ~~~~~~~~~~~
-      // .
-      // .
-      // .
-      // ---------
-      // high addr
-      //
-      // Start stack_index over at -kWordSize -- the location of the first
-      // formal -- since the return address is at rsp.
-      return AST_compile_code(ctx, /*formals=*/operand1(args),
-                              /*body=*/operand2(args), -kWordSize);
-    }
-    if (AST_atom_equals_cstr(fnexpr, "labelcall")) {
-      ASTNode *label = operand1(args);
-      assert(AST_is_atom(label));
-      char *name = label->value.atom;
-      int32_t code_pos;
-      if (!Env_lookup(ctx->labels, name, &code_pos)) {
-        fprintf(stderr, "Unbound label: `%s'\n", name);
-        return -1;
-      }
-      return AST_compile_labelcall(ctx, /*code_pos=*/code_pos,
-                                   /*args=*/AST_cdr(args), stack_index);
+// Primitives
+
+static int AST_compile_add1(CompilerContext *ctx, ASTNode *args,
+                            int stack_index) {
+  AST_compile_expr(ctx, operand1(args), stack_index);
+  Buffer_add_reg_imm32(ctx->writer, kRax, encodeImmediateFixnum(1));
+  return 0;
+}
+
+static int AST_compile_sub1(CompilerContext *ctx, ASTNode *args,
+                            int stack_index) {
+  AST_compile_expr(ctx, operand1(args), stack_index);
+  Buffer_sub_reg_imm32(ctx->writer, kRax, encodeImmediateFixnum(1));
+  return 0;
+}
+
+static int AST_compile_integer_to_char(CompilerContext *ctx, ASTNode *args,
+                                       int stack_index) {
+  AST_compile_expr(ctx, operand1(args), stack_index);
+  Buffer_shl_reg(ctx->writer, kRax, /*bits=*/kCharShift - kFixnumShift);
+  // TODO: generate more compact code since we know we're only or-ing with a
+  // byte
+  Buffer_or_reg_imm32(ctx->writer, kRax, kCharTag);
+  return 0;
+}
+
+static int AST_compile_zerop(CompilerContext *ctx, ASTNode *args,
+                             int stack_index) {
+  AST_compile_expr(ctx, operand1(args), stack_index);
+  Buffer_cmp_reg_imm32(ctx->writer, kRax, 0);
+  Buffer_box_equal_flag_as_bool(ctx->writer);
+  return 0;
+}
+
+// A fixnum literal is loaded with `mov eax, imm32`, which zero-extends, but
+// `add rax, imm32` sign-extends. They only agree when the encoded value is
+// non-negative as an int32, ie 0 <= fixnum < 2^29.
+static bool AST_is_add_immediate(ASTNode *node) {
+  return node->type == kFixnum && node->value.fixnum >= 0 &&
+         node->value.fixnum < (1 << (31 - kFixnumShift));
+}
+
+static int AST_compile_plus(CompilerContext *ctx, ASTNode *args,
+                            int stack_index) {
+  ASTNode *left = operand1(args);
+  ASTNode *right = operand2(args);
+  // If either operand is a small enough constant, add it as an immediate
+  // instead of spilling the other operand to the stack. Addition commutes, so
+  // either side will do.
+  if (AST_is_add_immediate(right)) {
+    AST_compile_expr(ctx, left, stack_index);
+    Buffer_add_reg64_imm32(ctx->writer, kRax,
+                           encodeImmediateFixnum(right->value.fixnum));
+    return 0;
+  }
+  if (AST_is_add_immediate(left)) {
+    AST_compile_expr(ctx, right, stack_index);
+    Buffer_add_reg64_imm32(ctx->writer, kRax,
+                           encodeImmediateFixnum(left->value.fixnum));
+    return 0;
+  }
+  AST_compile_expr(ctx, right, stack_index);
+  Buffer_mov_reg_to_stack(ctx->writer, kRax, /*offset=*/stack_index);
+  AST_compile_expr(ctx, left, stack_index - kWordSize);
+  Buffer_add_reg_stack(ctx->writer, kRax, /*offset=*/stack_index);
+  return 0;
+}
+
+static int AST_compile_car(CompilerContext *ctx, ASTNode *args,
+                           int stack_index) {
+  AST_compile_expr(ctx, operand1(args), stack_index);
+  // Since heap addresses are biased by 1, the car of a cons cell is at
+  // offset -1, instead of 0.
+  Buffer_mov_reg_disp_to_rax(ctx->writer, /*src=*/kRax, -1);
+  return 0;
+}
+
+static int AST_compile_cdr(CompilerContext *ctx, ASTNode *args,
+                           int stack_index) {
+  AST_compile_expr(ctx, operand1(args), stack_index);
+  // Since heap addresses are biased by 1, the cdr of a cons cell is at
+  // offset 7, instead of 8.
+  Buffer_mov_reg_disp_to_rax(ctx->writer, /*src=*/kRax, kWordSize - 1);
+  return 0;
+}
+
+// End Primitives
+
+// Special forms
+
+static int AST_compile_let_form(CompilerContext *ctx, ASTNode *args,
+                                int stack_index) {
+  return AST_compile_let(ctx, /*bindings=*/operand1(args),
+                         /*body=*/operand2(args), stack_index);
+}
+
+static int AST_compile_if_form(CompilerContext *ctx, ASTNode *args,
+                               int stack_index) {
+  // TODO: in if, rewrite empty iffalse => '()
+  return AST_compile_if(ctx, operand1(args), operand2(args), operand3(args),
+                        stack_index);
+}
+
+static int AST_compile_cons_form(CompilerContext *ctx, ASTNode *args,
+                                 int stack_index) {
+  return AST_compile_cons(ctx, operand1(args), operand2(args), stack_index);
+}
+
+static int AST_compile_code_form(CompilerContext *ctx, ASTNode *args,
+                                 int stack_index) {
+  (void)stack_index;
+  // The flow of control enters `code` in a new call frame. The stack looks
+  // like this:
+  //
+  // low addr
+  // --------
+  // .
+  // .
+  // .
+  // rsp   24: arg3
+  // rsp - 16: arg2
+  // rsp - 8 : arg1
+  // rsp     : return addr
+  // ~~~~~~~~~~~
+  // .
+  // .
+  // .
+  // ---------
+  // high addr
+  //
+  // Start stack_index over at -kWordSize -- the location of the first
+  // formal -- since the return address is at rsp.
+  return AST_compile_code(ctx, /*formals=*/operand1(args),
+                          /*body=*/operand2(args), -kWordSize);
+}
+
+static int AST_compile_labelcall_form(CompilerContext *ctx, ASTNode *args,
+                                      int stack_index) {
+  ASTNode *label = operand1(args);
+  assert(AST_is_atom(label));
+  char *name = label->value.atom;
+  int32_t code_pos;
+  if (!Env_lookup(ctx->labels, name, &code_pos)) {
+    fprintf(stderr, "Unbound label: `%s'\n", name);
+    return -1;
+  }
+  return AST_compile_labelcall(ctx, /*code_pos=*/code_pos,
+                               /*args=*/AST_cdr(args), stack_index);
+}
+
+// End Special forms
+
+typedef int (*CallCompiler)(CompilerContext *ctx, ASTNode *args,
+                            int stack_index);
+
+typedef struct {
+  char *name;
+  CallCompiler compile;
+} NamedCallCompiler;
+
+// Maps the operator of a call to the function that compiles it. Both
+// primitives and special forms live here, so compiling a call is one lookup
+// and one indirect call.
+static const NamedCallCompiler kCallCompilers[] = {
+    // Primitives
+    {"add1", AST_compile_add1},
+    {"sub1", AST_compile_sub1},
+    {"integer->char", AST_compile_integer_to_char},
+    {"zero?", AST_compile_zerop},
+    {"+", AST_compile_plus},
+    {"car", AST_compile_car},
+    {"cdr", AST_compile_cdr},
+    // Special forms
+    {"let", AST_compile_let_form},
+    {"if", AST_compile_if_form},
+    {"cons", AST_compile_cons_form},
+    {"code", AST_compile_code_form},
+    {"labelcall", AST_compile_labelcall_form},
+};
+
+// Return the compiler for calls whose operator is `fnexpr`, or NULL if there
+// is none.
+static CallCompiler CallCompiler_lookup(ASTNode *fnexpr) {
+  assert(AST_is_atom(fnexpr));
+  for (size_t i = 0; i < sizeof kCallCompilers / sizeof kCallCompilers[0];
+       i++) {
+    if (AST_atom_equals_cstr(fnexpr, kCallCompilers[i].name)) {
+      return kCallCompilers[i].compile;
     }
-    assert(0 && "unknown call");
   }
-  assert(0 && "unknown call");
+  return NULL;
+}
+
+static int AST_compile_call(CompilerContext *ctx, ASTNode *fnexpr,
+                            ASTNode *args, int stack_index) {
+  assert(AST_is_atom(fnexpr) && "unknown call");
+  CallCompiler compile = CallCompiler_lookup(fnexpr);
+  assert(compile != NULL && "unknown call");
+  return compile(ctx, args, stack_index);
 }
 
-int AST_compile_expr(CompilerContext *ctx, ASTNode *node, int stack_index) {
+static int AST_compile_expr(CompilerContext *ctx, ASTNode *node,
+                            int stack_index) {
   switch (node->type) {
   case kFixnum: {
     uint32_t value = (uint32_t)node->value.fixnum;
@@ -812,9 +956,15 @@ int AST_compile_function(CompilerContext *ctx, ASTNode *node) {
   return 0;
 }
 
+// Emitted at the start of every entry point. It never varies, so it is kept as
+// a ready-made byte sequence:
+//
+// 48 89 fe                mov    rsi,rdi
+static const byte kEntryPrologue[] = {0x48, 0x89, 0xfe};
+
 int AST_compile_entry(CompilerContext *ctx, ASTNode *node) {
   // Save the heap in rsi, our global heap pointer
-  Buffer_mov_reg_reg(ctx->writer, /*dst=*/kRsi, /*src=*/kRdi);
+  Buffer_write_arr(ctx->writer, kEntryPrologue, sizeof kEntryPrologue);
   return AST_compile_function(ctx, node);
 }
 
@@ -989,6 +1139,18 @@ TEST(mov_rcx_imm32) {
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
 }
 
+TEST(add_rax_imm32_64bit) {
+  Buffer_add_reg64_imm32(ctx->writer, kRax, 42);
+  byte expected[] = {0x48, 0x05, 0x2a, 0x00, 0x00, 0x00};
+  EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
+}
+
+TEST(add_rcx_imm32_64bit) {
+  Buffer_add_reg64_imm32(ctx->writer, kRcx, 42);
+  byte expected[] = {0x48, 0x81, 0xc1, 0x2a, 0x00, 0x00, 0x00};
+  EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
+}
+
 TEST(mov_inc) {
   Buffer_mov_reg_imm32(ctx->writer, kRax, 42);
   Buffer_inc_reg(ctx->writer, kRax);
@@ -1015,6 +1177,12 @@ TEST(mov_rdi_rbp) {
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
 }
 
+TEST(entry_prologue_matches_mov_rsi_rdi) {
+  Buffer_mov_reg_reg(ctx->writer, /*dst=*/kRsi, /*src=*/kRdi);
+  cmp_ok(ctx->writer->pos, "==", sizeof kEntryPrologue, __func__);
+  EXPECT_EQUALS_BYTES(ctx->writer->buf, kEntryPrologue);
+}
+
 TEST(compile_fixnum) {
   // 123
   ASTNode *node = AST_new_fixnum(123);
@@ -1104,10 +1272,9 @@ TEST(compile_add_two_ints) {
       list3(AST_new_atom("+"), AST_new_fixnum(1), AST_new_fixnum(2));
   int result = AST_compile_function(ctx, node);
   cmp_ok(result, "==", 0, __func__);
-  // mov eax, imm(2); mov [rsp-8], rax; mov rax, imm(1); add rax, [rsp-8]
-  byte expected[] = {0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x89,
-                     0x44, 0x24, 0xf8, 0xb8, 0x04, 0x00, 0x00,
-                     0x00, 0x48, 0x03, 0x44, 0x24, 0xf8, 0xc3};
+  // mov eax, imm(1); add rax, imm(2)
+  byte expected[] = {0xb8, 0x04, 0x00, 0x00, 0x00, 0x48,
+                     0x05, 0x08, 0x00, 0x00, 0x00, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
   EXPECT_CALL_EQUALS(ctx->writer->buf, encodeImmediateFixnum(3));
@@ -1121,18 +1288,12 @@ TEST(compile_add_three_ints) {
             list3(AST_new_atom("+"), AST_new_fixnum(2), AST_new_fixnum(3)));
   int result = AST_compile_function(ctx, node);
   cmp_ok(result, "==", 0, __func__);
-  // 0:  b8 0c 00 00 00          mov    eax,0xc
-  // 5:  48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // a:  b8 08 00 00 00          mov    eax,0x8
-  // f:  48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 14: 48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // 19: b8 04 00 00 00          mov    eax,0x4
-  // 1e: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 23: c3                      ret
-  byte expected[] = {0xb8, 0x0c, 0x00, 0x00, 0x00, 0x48, 0x89, 0x44, 0x24,
-                     0xf8, 0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x03, 0x44,
-                     0x24, 0xf8, 0x48, 0x89, 0x44, 0x24, 0xf8, 0xb8, 0x04,
-                     0x00, 0x00, 0x00, 0x48, 0x03, 0x44, 0x24, 0xf8, 0xc3};
+  // 0:  b8 08 00 00 00          mov    eax,0x8
+  // 5:  48 05 0c 00 00 00       add    rax,0xc
+  // b:  48 05 04 00 00 00       add    rax,0x4
+  // 11: c3                      ret
+  byte expected[] = {0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x05, 0x0c, 0x00,
+                     0x00, 0x00, 0x48, 0x05, 0x04, 0x00, 0x00, 0x00, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
   EXPECT_CALL_EQUALS(ctx->writer->buf, encodeImmediateFixnum(6));
@@ -1147,22 +1308,16 @@ TEST(compile_add_four_ints) {
             list3(AST_new_atom("+"), AST_new_fixnum(3), AST_new_fixnum(4)));
   int result = AST_compile_function(ctx, node);
   cmp_ok(result, "==", 0, __func__);
-  // 0:  b8 10 00 00 00          mov    eax,0x10
-  // 5:  48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // a:  b8 0c 00 00 00          mov    eax,0xc
-  // f:  48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 14: 48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // 19: b8 08 00 00 00          mov    eax,0x8
-  // 1e: 48 89 44 24 f0          mov    QWORD PTR [rsp-0x10],rax
-  // 23: b8 04 00 00 00          mov    eax,0x4
-  // 28: 48 03 44 24 f0          add    rax,QWORD PTR [rsp-0x10]
-  // 2d: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 32: c3                      ret
-  byte expected[] = {0xb8, 0x10, 0x00, 0x00, 0x00, 0x48, 0x89, 0x44, 0x24,
-                     0xf8, 0xb8, 0x0c, 0x00, 0x00, 0x00, 0x48, 0x03, 0x44,
-                     0x24, 0xf8, 0x48, 0x89, 0x44, 0x24, 0xf8, 0xb8, 0x08,
-                     0x00, 0x00, 0x00, 0x48, 0x89, 0x44, 0x24, 0xf0, 0xb8,
-                     0x04, 0x00, 0x00, 0x00, 0x48, 0x03, 0x44, 0x24, 0xf0,
+  // 0:  b8 0c 00 00 00          mov    eax,0xc
+  // 5:  48 05 10 00 00 00       add    rax,0x10
+  // b:  48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
+  // 10: b8 04 00 00 00          mov    eax,0x4
+  // 15: 48 05 08 00 00 00       add    rax,0x8
+  // 1b: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
+  // 20: c3                      ret
+  byte expected[] = {0xb8, 0x0c, 0x00, 0x00, 0x00, 0x48, 0x05, 0x10, 0x00,
+                     0x00, 0x00, 0x48, 0x89, 0x44, 0x24, 0xf8, 0xb8, 0x04,
+                     0x00, 0x00, 0x00, 0x48, 0x05, 0x08, 0x00, 0x00, 0x00,
                      0x48, 0x03, 0x44, 0x24, 0xf8, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
@@ -1255,10 +1410,9 @@ TEST(let_with_no_bindings) {
       /*body*/ list3(AST_new_atom("+"), AST_new_fixnum(1), AST_new_fixnum(2)));
   int result = AST_compile_function(ctx, node);
   cmp_ok(result, "==", 0, __func__);
-  // mov eax, imm(2); mov [rsp-8], rax; mov rax, imm(1); add rax, [rsp-8]
-  byte expected[] = {0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x89,
-                     0x44, 0x24, 0xf8, 0xb8, 0x04, 0x00, 0x00,
-                     0x00, 0x48, 0x03, 0x44, 0x24, 0xf8, 0xc3};
+  // mov eax, imm(1); add rax, imm(2)
+  byte expected[] = {0xb8, 0x04, 0x00, 0x00, 0x00, 0x48,
+                     0x05, 0x08, 0x00, 0x00, 0x00, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
   EXPECT_CALL_EQUALS(ctx->writer->buf, encodeImmediateFixnum(3));
@@ -1276,14 +1430,11 @@ TEST(let_with_one_binding) {
   // 0:  b8 08 00 00 00          mov    eax,0x08
   // 5:  48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
   // a:  48 8b 44 24 f8          mov    rax,QWORD PTR [rsp-0x8]
-  // f:  48 89 44 24 f0          mov    QWORD PTR [rsp-0x10],rax
-  // 14: b8 04 00 00 00          mov    eax,0x4
-  // 19: 48 03 44 24 f0          add    rax,QWORD PTR [rsp-0x10]
-  // 1e: c3                      ret
+  // f:  48 05 04 00 00 00       add    rax,0x4
+  // 15: c3                      ret
   byte expected[] = {0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x89, 0x44,
                      0x24, 0xf8, 0x48, 0x8b, 0x44, 0x24, 0xf8, 0x48,
-                     0x89, 0x44, 0x24, 0xf0, 0xb8, 0x04, 0x00, 0x00,
-                     0x00, 0x48, 0x03, 0x44, 0x24, 0xf0, 0xc3};
+                     0x05, 0x04, 0x00, 0x00, 0x00, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
   EXPECT_CALL_EQUALS(ctx->writer->buf, encodeImmediateFixnum(3));
@@ -1325,28 +1476,22 @@ TEST(compile_if_test_true) {
   // 17: 48 0d 1f 00 00 00       or     rax,0x1f
   // -> if
   // 1d: 48 3d 1f 00 00 00       cmp    rax,0x1f
-  // 23: 0f 84 19 00 00 00       je     0x42
+  // 23: 0f 84 10 00 00 00       je     0x39
   // +
-  // 29: b8 08 00 00 00          mov    eax,0x8
-  // 2e: 48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // 33: b8 04 00 00 00          mov    eax,0x4
-  // 38: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 3d: e9 14 00 00 00          jmp    0x56
+  // 29: b8 04 00 00 00          mov    eax,0x4
+  // 2e: 48 05 08 00 00 00       add    rax,0x8
+  // 34: e9 0b 00 00 00          jmp    0x44
   // +
-  // 42: b8 10 00 00 00          mov    eax,0x10
-  // 47: 48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // 4c: b8 0c 00 00 00          mov    eax,0xc
-  // 51: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 56: c3                      ret
+  // 39: b8 0c 00 00 00          mov    eax,0xc
+  // 3e: 48 05 10 00 00 00       add    rax,0x10
+  // 44: c3                      ret
   byte expected[] = {0xb8, 0x00, 0x00, 0x00, 0x00, 0x48, 0x3d, 0x00, 0x00, 0x00,
                      0x00, 0xb8, 0x00, 0x00, 0x00, 0x00, 0x0f, 0x94, 0xc0, 0x48,
                      0xc1, 0xe0, 0x07, 0x48, 0x0d, 0x1f, 0x00, 0x00, 0x00, 0x48,
-                     0x3d, 0x1f, 0x00, 0x00, 0x00, 0x0f, 0x84, 0x19, 0x00, 0x00,
-                     0x00, 0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x89, 0x44, 0x24,
-                     0xf8, 0xb8, 0x04, 0x00, 0x00, 0x00, 0x48, 0x03, 0x44, 0x24,
-                     0xf8, 0xe9, 0x14, 0x00, 0x00, 0x00, 0xb8, 0x10, 0x00, 0x00,
-                     0x00, 0x48, 0x89, 0x44, 0x24, 0xf8, 0xb8, 0x0c, 0x00, 0x00,
-                     0x00, 0x48, 0x03, 0x44, 0x24, 0xf8, 0xc3};
+                     0x3d, 0x1f, 0x00, 0x00, 0x00, 0x0f, 0x84, 0x10, 0x00, 0x00,
+                     0x00, 0xb8, 0x04, 0x00, 0x00, 0x00, 0x48, 0x05, 0x08, 0x00,
+                     0x00, 0x00, 0xe9, 0x0b, 0x00, 0x00, 0x00, 0xb8, 0x0c, 0x00,
+                     0x00, 0x00, 0x48, 0x05, 0x10, 0x00, 0x00, 0x00, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
   EXPECT_CALL_EQUALS(ctx->writer->buf, encodeImmediateFixnum(3));
@@ -1369,28 +1514,22 @@ TEST(compile_if_test_false) {
   // 17: 48 0d 1f 00 00 00       or     rax,0x1f
   // -> if
   // 1d: 48 3d 1f 00 00 00       cmp    rax,0x1f
-  // 23: 0f 84 19 00 00 00       je     0x42
+  // 23: 0f 84 10 00 00 00       je     0x39
   // +
-  // 29: b8 08 00 00 00          mov    eax,0x8
-  // 2e: 48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // 33: b8 04 00 00 00          mov    eax,0x4
-  // 38: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 3d: e9 14 00 00 00          jmp    0x56
+  // 29: b8 04 00 00 00          mov    eax,0x4
+  // 2e: 48 05 08 00 00 00       add    rax,0x8
+  // 34: e9 0b 00 00 00          jmp    0x44
   // +
-  // 42: b8 10 00 00 00          mov    eax,0x10
-  // 47: 48 89 44 24 f8          mov    QWORD PTR [rsp-0x8],rax
-  // 4c: b8 0c 00 00 00          mov    eax,0xc
-  // 51: 48 03 44 24 f8          add    rax,QWORD PTR [rsp-0x8]
-  // 56: c3                      ret
+  // 39: b8 0c 00 00 00          mov    eax,0xc
+  // 3e: 48 05 10 00 00 00       add    rax,0x10
+  // 44: c3                      ret
   byte expected[] = {0xb8, 0x04, 0x00, 0x00, 0x00, 0x48, 0x3d, 0x00, 0x00, 0x00,
                      0x00, 0xb8, 0x00, 0x00, 0x00, 0x00, 0x0f, 0x94, 0xc0, 0x48,
                      0xc1, 0xe0, 0x07, 0x48, 0x0d, 0x1f, 0x00, 0x00, 0x00, 0x48,
-                     0x3d, 0x1f, 0x00, 0x00, 0x00, 0x0f, 0x84, 0x19, 0x00, 0x00,
-                     0x00, 0xb8, 0x08, 0x00, 0x00, 0x00, 0x48, 0x89, 0x44, 0x24,
-                     0xf8, 0xb8, 0x04, 0x00, 0x00, 0x00, 0x48, 0x03, 0x44, 0x24,
-                     0xf8, 0xe9, 0x14, 0x00, 0x00, 0x00, 0xb8, 0x10, 0x00, 0x00,
-                     0x00, 0x48, 0x89, 0x44, 0x24, 0xf8, 0xb8, 0x0c, 0x00, 0x00,
-                     0x00, 0x48, 0x03, 0x44, 0x24, 0xf8, 0xc3};
+                     0x3d, 0x1f, 0x00, 0x00, 0x00, 0x0f, 0x84, 0x10, 0x00, 0x00,
+                     0x00, 0xb8, 0x04, 0x00, 0x00, 0x00, 0x48, 0x05, 0x08, 0x00,
+                     0x00, 0x00, 0xe9, 0x0b, 0x00, 0x00, 0x00, 0xb8, 0x0c, 0x00,
+                     0x00, 0x00, 0x48, 0x05, 0x10, 0x00, 0x00, 0x00, 0xc3};
   EXPECT_EQUALS_BYTES(ctx->writer->buf, expected);
   Buffer_make_executable(ctx->writer->buf);
   EXPECT_CALL_EQUALS(ctx->writer->buf, encodeImmediateFixnum(7));
@@ -1719,16 +1858,54 @@ TEST(compile_with_read) {
   cmp_ok(result, "==", encodeImmediateFixnum(5), __func__);
 }
 
+TEST(compile_add_literal_past_32_bits) {
+  // Each fixnum encodes to 0x7fffffc, so the sum only fits in 64 bits. The
+  // literal 0 must not truncate the nested sum to 32 bits.
+  uint64_t result =
+      Run_from_cstr("(let ((a 536870911) (b 536870911) (c 536870911)) "
+                    "(+ (+ (+ a b) c) 0))",
+                    ctx, heap);
+  // cmp_ok compares ints, which would hide a truncated upper half.
+  ok(result == 3 * (uint64_t)encodeImmediateFixnum(536870911), __func__);
+}
+
+TEST(compile_add_literal_to_variable_past_32_bits) {
+  // (+ x 1) where x already holds a sum wider than 32 bits.
+  uint64_t result =
+      Run_from_cstr("(let ((a 536870911) (b 536870911) (c 536870911)) "
+                    "(let ((x (+ (+ a b) c))) (+ x 1)))",
+                    ctx, heap);
+  ok(result == 3 * (uint64_t)encodeImmediateFixnum(536870911) +
+                   encodeImmediateFixnum(1),
+     __func__);
+}
+
+TEST(compile_add_large_literal_zero_extends) {
+  // imm(536870912) is 0x80000000, which `add rax, imm32` would sign-extend. The
+  // result must match adding the same value held in a variable.
+  uint64_t result = Run_from_cstr("(let ((x 1)) (+ x 536870912))", ctx, heap);
+  ok(result == (uint64_t)(536870912 + 1) << kFixnumShift, __func__);
+}
+
+TEST(compile_let_with_dependent_bindings) {
+  uint64_t result =
+      Run_from_cstr("(let ((x 2) (y (+ x x))) (+ x y))", ctx, heap);
+  cmp_ok(result, "==", encodeImmediateFixnum(6), __func__);
+}
+
 int run_tests() {
   plan(NO_PLAN);
   run_test(test_write_bytes_manually);
   run_test(test_write_bytes_manually2);
   run_test(test_mov_rax_imm32);
   run_test(test_mov_rcx_imm32);
+  run_test(test_add_rax_imm32_64bit);
+  run_test(test_add_rcx_imm32_64bit);
   run_test(test_mov_inc);
   run_test(test_mov_rax_rax);
   run_test(test_mov_rax_rsi);
   run_test(test_mov_rdi_rbp);
+  run_test(test_entry_prologue_matches_mov_rsi_rdi);
   run_test(test_compile_fixnum);
   run_test(test_compile_primcall_add1);
   run_test(test_compile_primcall_sub1);
@@ -1764,6 +1941,10 @@ int run_tests() {
   run_test(test_read_with_list_returns_list);
   run_test(test_read_with_nested_list_returns_list);
   run_test(test_compile_with_read);
+  run_test(test_compile_add_literal_past_32_bits);
+  run_test(test_compile_add_literal_to_variable_past_32_bits);
+  run_test(test_compile_add_large_literal_zero_extends);
+  run_test(test_compile_let_with_dependent_bindings);
   done_testing();
 }
 